@@ -7,24 +7,32 @@ CEnT-S Alert System v3 - DUAL MODE (Webhook + Polling Fallback)
 - Aggressive health monitoring and auto-recovery
 """
 
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 import os
+import sys
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
 import asyncio
-from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
 from contextlib import asynccontextmanager
 import time
+import hashlib
+import hmac
+import random
+import re
+import orjson
 
 # ========== CONFIGURATION ==========
 ROOT_DIR = Path(__file__).parent
@@ -34,15 +42,69 @@ TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 MONGO_URL = os.environ['MONGO_URL']
 DB_NAME = os.environ['DB_NAME']
 
-# Simple webhook path using token hash for security
+# Simple webhook path; requests are authenticated by a secret derived from the token
 WEBHOOK_PATH = "/api/tg/wh"
+WEBHOOK_SECRET = hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()
+_WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()
 
 CISIA_URL = "https://testcisia.it/calendario.php?tolc=cents&lingua=inglese"
 
+FRONTEND_ENV = Path("/app/frontend/.env")
+_ENV_RE = re.compile(r'^REACT_APP_BACKEND_URL=\s*"?([^"\n]+?)"?\s*$', re.MULTILINE)
+
+# HTTP pools - Telegram and the scraper get separate pools so a slow
+# CISIA response can never starve alert sends
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 32))
+TELEGRAM_POOL_TIMEOUT = float(os.environ.get('TELEGRAM_POOL_TIMEOUT', 8.0))
+SCRAPE_POOL_SIZE = 4
+
+# Retry backoff (full jitter): sleep uniform(0, min(cap, base * 2**attempt))
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 30.0
+
+# Write a snapshot at least this often even when nothing changed, so the
+# latest snapshot timestamp doubles as a "scraper is alive" heartbeat
+SNAPSHOT_HEARTBEAT = 3600
+
+# getUpdates long-poll window (seconds) in polling fallback mode
+LONG_POLL_TIMEOUT = 30
+
+# Non-command chatter gets at most one "here's your ID" reply per chat
+# per window, and none at all outside private chats
+DEFAULT_REPLY_INTERVAL = 10
+DEFAULT_REPLY_MAX_CHATS = 10000
+
+# getMe only changes if the token is rotated
+BOT_INFO_TTL = 3600
+
+# Health monitor cadence: fast while unhealthy, relaxed after a green streak
+HEALTH_FAST_INTERVAL = 30
+HEALTH_SLOW_INTERVAL = 300
+HEALTH_OK_STREAK = 5
+HEALTH_PROBE_TIMEOUT = 10
+
+# Webhook updates are queued and drained by a fixed worker pool so a
+# message flood applies back-pressure instead of spawning unbounded tasks
+MSG_QUEUE_SIZE = 500
+MSG_WORKERS = 8
+
+# Command replies are queued too, so handlers never wait on sendMessage
+REPLY_QUEUE_SIZE = 1000
+REPLY_WORKERS = 4
+
+# Telegram allows ~30 msg/s globally - stay just under it when broadcasting
+SEND_CONCURRENCY = 25
+SEND_CHUNK_INTERVAL = 1.05
+
 # MongoDB
-client = AsyncIOMotorClient(MONGO_URL)
+client = AsyncIOMotorClient(MONGO_URL, tz_aware=True)
 db = client[DB_NAME]
 
+# Persistent HTTP clients (created in lifespan, reused for keep-alive)
+TG_CLIENT: Optional[httpx.AsyncClient] = None
+SCRAPE_CLIENT: Optional[httpx.AsyncClient] = None
+AUTH_CLIENT: Optional[httpx.AsyncClient] = None
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -64,9 +126,12 @@ class State:
         self.last_msg_sent = 0
         self.msg_received_count = 0
         self.msg_sent_count = 0
+        self.last_default_reply = {}  # chat_id -> time of last non-command reply
         
         # Health
         self.health_checks = 0
+        self.consecutive_ok = 0
+        self.first_failure_at = 0  # start of the current failing streak, 0 = healthy
         self.auto_recoveries = 0
         self.errors = 0
         
@@ -76,9 +141,21 @@ class State:
         
         # System
         self.bot_username = None
+        self.bot_info = None
+        self.bot_info_ts = 0
+        self.base_url = None
         self.start_time = time.time()
-        self.scraper_running = False
-        self.monitor_running = False
+        self.stop_event = asyncio.Event()  # set on shutdown; wakes sleeping loops
+        self.scrape_wake = asyncio.Event()  # set to run the scraper ahead of schedule
+        
+        # Scraper change detection
+        self.last_etag = None
+        self.last_modified = None
+        self.last_content_hash = None
+        self.last_available_keys = None  # set of "university|test_date", None = no baseline yet
+        self.last_snapshot_hash = None
+        self.last_snapshot_at = 0
+        self.latest_snapshot = None  # pre-serialized /availability bodies for the last stored snapshot
 
 state = State()
 
@@ -98,49 +175,165 @@ class TelegramConnectRequest(BaseModel):
 class AlertSettingsRequest(BaseModel):
     alert_telegram: bool
 
-class AvailabilitySpot(BaseModel):
-    spot_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    type: str
-    university: str
-    region: str
-    city: str
-    registration_deadline: str
-    spots: str
-    status: str
-    test_date: str
+def spot_key(spot: dict) -> str:
+    """Identity used to diff spots between scrapes."""
+    return f"{spot['university']}|{spot['test_date']}"
+
+# ========== BACKGROUND TASKS ==========
+# Strong references to fire-and-forget tasks so they can't be garbage
+# collected mid-flight, and so shutdown can cancel and await them.
+_background_tasks: set = set()
+
+
+def _task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Task {task.get_name()} crashed: {task.exception()}")
+
+
+def spawn(coro, name: str = None) -> asyncio.Task:
+    """Start a supervised background task."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+
+async def cancel_background_tasks():
+    """Cancel every supervised task and wait for them to unwind."""
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 
 # ========== TELEGRAM API ==========
-async def tg_api(method: str, data: dict = None, retries: int = 3) -> dict:
-    """Telegram API call with retries."""
-    if not TELEGRAM_BOT_TOKEN:
-        return {"ok": False, "error": "No token"}
+class AsyncCircuitBreaker:
+    """Fail fast while Telegram is unreachable.
+    
+    closed    -> calls pass; `failure_threshold` consecutive failures opens it
+    open      -> calls are rejected until `reset_timeout` has elapsed
+    half_open -> a single probe is let through; success closes, failure re-opens
+    """
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started = 0.0
+        self.trips = 0
+    
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+        # A probe that never reported back (e.g. cancelled) expires too
+        if self.probe_in_flight and time.monotonic() - self.probe_started < self.reset_timeout:
+            return False
+        self.probe_in_flight = True
+        self.probe_started = time.monotonic()
+        return True
+    
+    def on_success(self):
+        if self.state != "closed":
+            logger.info("🔌 Telegram circuit closed")
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    def on_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"🔌 Telegram circuit OPEN after {self.failures} failures")
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+tg_breaker = AsyncCircuitBreaker()
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+async def tg_api(method: str, data: dict = None, retries: int = 3, timeout=httpx.USE_CLIENT_DEFAULT) -> dict:
+    """Telegram API call with retries. `timeout` overrides the client default."""
+    if not TELEGRAM_BOT_TOKEN or TG_CLIENT is None:
+        return {"ok": False, "error": "No token"}
     
+    # Encode once, not on every retry
+    payload = orjson.dumps(data) if data else None
     for i in range(retries):
+        if not tg_breaker.allow():
+            return {"ok": False, "cb": "open"}
+        r = None
         try:
-            async with httpx.AsyncClient(timeout=15.0) as http:
-                r = await http.post(url, json=data) if data else await http.get(url)
-                result = r.json()
-                
-                if result.get("ok"):
-                    return result
+            if payload:
+                r = await TG_CLIENT.post(f"/{method}", content=payload, headers=_JSON_HEADERS, timeout=timeout)
+            else:
+                r = await TG_CLIENT.get(f"/{method}", timeout=timeout)
+            # Only transport errors and 5xx mean Telegram is unhealthy;
+            # a 4xx (bad chat id, blocked bot) is our problem, not an outage
+            if r.status_code >= 500:
+                tg_breaker.on_failure()
+            else:
+                tg_breaker.on_success()
+            result = orjson.loads(r.content)
+            
+            if result.get("ok"):
+                return result
+            
+            # Rate limit - honour retry_after, plus up to 20% jitter so
+            # concurrent senders don't all come back in the same instant
+            if r.status_code == 429:
+                wait = result.get("parameters", {}).get("retry_after", 5)
+                await asyncio.sleep(wait * random.uniform(1.0, 1.2))
+                continue
                 
-                # Rate limit
-                if r.status_code == 429:
-                    wait = result.get("parameters", {}).get("retry_after", 5)
-                    await asyncio.sleep(wait)
-                    continue
-                    
         except Exception as e:
+            # A reply that arrived was already counted by its status code
+            # (e.g. a 502 HTML page failing to decode) - count each attempt once
+            if r is None:
+                tg_breaker.on_failure()
             logger.warning(f"API {method} failed ({i+1}/{retries}): {e}")
         
-        await asyncio.sleep(1)
+        if i < retries - 1:
+            await asyncio.sleep(random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** i)))
     
     state.errors += 1
     return {"ok": False}
 
 
+async def get_bot_info() -> Optional[dict]:
+    """getMe, cached on state for BOT_INFO_TTL seconds."""
+    if state.bot_info and time.time() - state.bot_info_ts < BOT_INFO_TTL:
+        return state.bot_info
+    info = await tg_api("getMe")
+    if info.get("ok"):
+        result = info["result"]
+        state.bot_info = {"username": result["username"], "name": result["first_name"]}
+        state.bot_info_ts = time.time()
+        state.bot_username = result["username"]
+    elif state.bot_username is None:
+        state.bot_username = "unknown"
+    return state.bot_info
+
+
+# Telegram HTML mode only needs &, < and > escaped; translate() does it in one pass
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+def escape_html(text) -> str:
+    return str(text).translate(_HTML_ESCAPE)
+
+
 async def send_msg(chat_id, text: str) -> bool:
     """Send Telegram message."""
     result = await tg_api("sendMessage", {"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
@@ -168,7 +361,8 @@ async def setup_webhook(base_url: str) -> bool:
     result = await tg_api("setWebhook", {
         "url": webhook_url,
         "allowed_updates": ["message"],
-        "drop_pending_updates": True
+        "drop_pending_updates": True,
+        "secret_token": WEBHOOK_SECRET
     })
     
     if not result.get("ok"):
@@ -193,7 +387,11 @@ async def setup_webhook(base_url: str) -> bool:
 
 async def check_webhook_health(base_url: str):
     """Check if webhook is healthy, switch to polling if not."""
-    info = await tg_api("getWebhookInfo")
+    try:
+        info = await asyncio.wait_for(tg_api("getWebhookInfo"), timeout=HEALTH_PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ getWebhookInfo timed out")
+        info = {}
     result = info.get("result", {})
     
     url = result.get("url", "")
@@ -216,12 +414,17 @@ async def check_webhook_health(base_url: str):
     state.health_checks += 1
     
     if issues:
+        state.consecutive_ok = 0
+        if not state.first_failure_at:
+            state.first_failure_at = time.time()
         logger.warning(f"⚠️ Webhook issues: {issues}")
         
-        # If webhook has been failing for 2+ minutes, switch to polling
-        time_since_success = time.time() - state.last_webhook_success
+        # If webhook has been failing for 2+ minutes, switch to polling.
+        # Measured from the first failed check, not the last good one - on
+        # the slow cadence that can already be minutes old.
+        failing_for = time.time() - state.first_failure_at
         
-        if time_since_success > 120 and state.mode == "webhook":
+        if failing_for > 120 and state.mode == "webhook":
             logger.warning("🔄 Switching to POLLING mode!")
             state.mode = "polling"
             await tg_api("deleteWebhook", {"drop_pending_updates": False})
@@ -233,6 +436,8 @@ async def check_webhook_health(base_url: str):
             await setup_webhook(base_url)
             state.auto_recoveries += 1
     else:
+        state.consecutive_ok += 1
+        state.first_failure_at = 0
         state.last_webhook_success = time.time()
         logger.info(f"✅ Webhook healthy (pending: {pending})")
         
@@ -252,11 +457,17 @@ async def polling_loop():
     
     while state.mode == "polling":
         try:
+            # True long polling: Telegram holds the request open until an
+            # update arrives or LONG_POLL_TIMEOUT elapses, so no idle sleep
             result = await tg_api("getUpdates", {
                 "offset": offset,
-                "timeout": 5,
+                "timeout": LONG_POLL_TIMEOUT,
                 "allowed_updates": ["message"]
-            })
+            }, timeout=LONG_POLL_TIMEOUT + 5)
+            
+            if not result.get("ok"):
+                await asyncio.sleep(1)
+                continue
             
             updates = result.get("result", [])
             for update in updates:
@@ -266,8 +477,7 @@ async def polling_loop():
                     
         except Exception as e:
             logger.error(f"Polling error: {e}")
-        
-        await asyncio.sleep(0.5)
+            await asyncio.sleep(0.1)
     
     logger.info("📡 Polling loop stopped")
 
@@ -275,7 +485,7 @@ async def polling_loop():
 def start_polling():
     """Start polling task."""
     if state.polling_task is None or state.polling_task.done():
-        state.polling_task = asyncio.create_task(polling_loop())
+        state.polling_task = spawn(polling_loop(), name="polling")
 
 
 def stop_polling():
@@ -285,6 +495,56 @@ def stop_polling():
 
 
 # ========== MESSAGE HANDLING ==========
+# Reply templates, built once at import
+HELP_TEXT = "/start - Get Chat ID\n/status - Bot status\n/id - Show ID"
+_START_TMPL = (
+    "👋 <b>Welcome, {name}!</b>\n\n"
+    "🔑 Your Chat ID:\n<code>{cid}</code>\n\n"
+    "👆 Tap to copy, paste in app!"
+)
+_STATUS_TMPL = (
+    "🤖 <b>Status: ONLINE</b>\n"
+    "Mode: {mode}\n"
+    "Uptime: {h}h {m}m\n"
+    "Messages: {rx} in, {tx} out\n"
+    "ID: <code>{cid}</code>"
+)
+_ID_TMPL = "🔑 <code>{cid}</code>"
+_DEFAULT_TMPL = "ID: <code>{cid}</code>\nSend /start for help"
+
+
+def _start_resp(chat_id, name: str) -> str:
+    return _START_TMPL.format(name=escape_html(name), cid=chat_id)
+
+
+def _status_resp(chat_id, name: str) -> str:
+    uptime = int(time.time() - state.start_time)
+    return _STATUS_TMPL.format(
+        mode=state.mode.upper(), h=uptime // 3600, m=(uptime % 3600) // 60,
+        rx=state.msg_received_count, tx=state.msg_sent_count, cid=chat_id
+    )
+
+
+def _id_resp(chat_id, name: str) -> str:
+    return _ID_TMPL.format(cid=chat_id)
+
+
+def _help_resp(chat_id, name: str) -> str:
+    return HELP_TEXT
+
+
+def _default_resp(chat_id, name: str) -> str:
+    return _DEFAULT_TMPL.format(cid=chat_id)
+
+
+COMMANDS = {
+    "/start": _start_resp,
+    "/status": _status_resp,
+    "/id": _id_resp,
+    "/help": _help_resp,
+}
+
+
 async def handle_message(message: dict):
     """Handle incoming Telegram message."""
     try:
@@ -300,77 +560,196 @@ async def handle_message(message: dict):
         
         logger.info(f"📩 [{chat_id}] {text[:30]}")
         
-        if text.startswith("/start"):
-            response = (
-                f"👋 <b>Welcome, {name}!</b>\n\n"
-                f"🔑 Your Chat ID:\n<code>{chat_id}</code>\n\n"
-                f"👆 Tap to copy, paste in app!"
-            )
-        elif text.startswith("/status"):
-            uptime = int(time.time() - state.start_time)
-            h, m = uptime // 3600, (uptime % 3600) // 60
-            response = (
-                f"🤖 <b>Status: ONLINE</b>\n"
-                f"Mode: {state.mode.upper()}\n"
-                f"Uptime: {h}h {m}m\n"
-                f"Messages: {state.msg_received_count} in, {state.msg_sent_count} out\n"
-                f"ID: <code>{chat_id}</code>"
-            )
-        elif text.startswith("/id"):
-            response = f"🔑 <code>{chat_id}</code>"
-        elif text.startswith("/help"):
-            response = "/start - Get Chat ID\n/status - Bot status\n/id - Show ID"
-        else:
-            response = f"ID: <code>{chat_id}</code>\nSend /start for help"
+        # "/start@MyBot payload" -> "/start"
+        parts = text.split(maxsplit=1)
+        cmd = parts[0].split("@", 1)[0] if parts else ""
+        handler = COMMANDS.get(cmd)
+        if handler is None:
+            if message.get("chat", {}).get("type", "private") != "private":
+                return
+            now = time.time()
+            if now - state.last_default_reply.get(chat_id, 0) < DEFAULT_REPLY_INTERVAL:
+                return
+            if len(state.last_default_reply) >= DEFAULT_REPLY_MAX_CHATS:
+                state.last_default_reply = {
+                    c: t for c, t in state.last_default_reply.items() if now - t < DEFAULT_REPLY_INTERVAL
+                }
+            state.last_default_reply[chat_id] = now
+            handler = _default_resp
+        response = handler(chat_id, name)
         
-        await send_msg(chat_id, response)
+        try:
+            REPLY_QUEUE.put_nowait((chat_id, response))
+        except asyncio.QueueFull:
+            logger.warning(f"⚠️ Reply queue full, dropping reply to {chat_id}")
         
     except Exception as e:
         logger.error(f"Handle message error: {e}")
 
 
+MSG_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=MSG_QUEUE_SIZE)
+REPLY_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=REPLY_QUEUE_SIZE)
+
+
+async def message_worker():
+    """Drain queued webhook messages."""
+    while True:
+        message = await MSG_QUEUE.get()
+        try:
+            await handle_message(message)
+        finally:
+            MSG_QUEUE.task_done()
+
+
+async def reply_worker():
+    """Drain queued command replies."""
+    while True:
+        chat_id, text = await REPLY_QUEUE.get()
+        try:
+            await send_msg(chat_id, text)
+        except Exception as e:
+            logger.error(f"Reply error: {e}")
+        finally:
+            REPLY_QUEUE.task_done()
+
+
 # ========== SCRAPER ==========
-async def scrape_cisia() -> List[AvailabilitySpot]:
-    """Scrape CISIA for CENT@CASA spots."""
+_CASA_RE = re.compile(rb'CASA', re.IGNORECASE)
+
+
+def parse_cisia(body: bytes) -> List[dict]:
+    """Extract CENT@CASA rows from the CISIA calendar page.
+    
+    Pure CPU work with no shared state, so it can run off the event loop.
+    """
     spots = []
+    # No CASA sessions listed at all - skip building the DOM
+    if not _CASA_RE.search(body):
+        return spots
+    
+    # Bytes go straight to the C parser - no Python-level str decode
+    tree = HTMLParser(body)
+    table = tree.css_first('table')
+    
+    if table:
+        for row in table.css('tr'):
+            # Check the test type before collecting the rest of the row
+            first = row.css_first('td')
+            if first is None:
+                continue
+            test_type = first.text(strip=True)
+            if "CASA" not in test_type.upper():
+                continue
+            cells = row.css('td')
+            if len(cells) >= 7:
+                status = "POSTI DISPONIBILI" if cells[6].css_first('a') is not None else cells[6].text(strip=True)
+                spots.append({
+                    # Row position - unique within a scrape, which is all
+                    # the frontend needs it for (list keys)
+                    "spot_id": str(len(spots)),
+                    "type": test_type,
+                    # Interned: the same few universities/regions/cities repeat
+                    # across rows and every scrape, and the latest snapshot
+                    # stays in memory
+                    "university": sys.intern(cells[1].text(strip=True)),
+                    "region": sys.intern(cells[2].text(strip=True)),
+                    "city": sys.intern(cells[3].text(strip=True)),
+                    "registration_deadline": cells[4].text(strip=True),
+                    "spots": cells[5].text(strip=True),
+                    "status": status,
+                    "test_date": cells[7].text(strip=True) if len(cells) > 7 else "",
+                    "is_available": "DISPONIBILI" in status.upper()
+                })
+    return spots
+
+
+async def scrape_cisia(conditional: bool = False) -> Optional[Tuple[List[dict], tuple]]:
+    """Scrape CISIA for CENT@CASA spots, as plain dicts ready for Mongo.
+    
+    Returns (spots, validators), or None when the fetch failed or - with
+    conditional=True - the page is unchanged since the last processed scrape
+    (HTTP 304 or identical content hash). `validators` are only recorded
+    once the caller has processed the spots, via remember_validators().
+    """
     try:
-        async with httpx.AsyncClient(timeout=30.0) as http:
-            r = await http.get(CISIA_URL, headers={"User-Agent": "Mozilla/5.0"})
-            soup = BeautifulSoup(r.text, 'lxml')
-            table = soup.find('table')
-            
-            if table:
-                for row in table.find_all('tr'):
-                    cells = row.find_all('td')
-                    if len(cells) >= 7:
-                        test_type = cells[0].get_text(strip=True)
-                        if "CASA" in test_type.upper():
-                            status = "POSTI DISPONIBILI" if cells[6].find('a') else cells[6].get_text(strip=True)
-                            spots.append(AvailabilitySpot(
-                                type=test_type,
-                                university=cells[1].get_text(strip=True),
-                                region=cells[2].get_text(strip=True),
-                                city=cells[3].get_text(strip=True),
-                                registration_deadline=cells[4].get_text(strip=True),
-                                spots=cells[5].get_text(strip=True),
-                                status=status,
-                                test_date=cells[7].get_text(strip=True) if len(cells) > 7 else ""
-                            ))
+        headers = {}
+        if conditional:
+            if state.last_etag:
+                headers["If-None-Match"] = state.last_etag
+            if state.last_modified:
+                headers["If-Modified-Since"] = state.last_modified
+        
+        r = await SCRAPE_CLIENT.get(CISIA_URL, headers=headers)
+        
+        if conditional and r.status_code == 304:
+            return None
+        if r.status_code != 200:
+            # An error page isn't an empty calendar - keep the current baseline
+            logger.error(f"Scrape error: HTTP {r.status_code}")
+            return None
+        
+        digest = hashlib.blake2b(r.content, digest_size=16).digest()
+        if conditional and digest == state.last_content_hash:
+            return None
+        validators = (r.headers.get("ETag"), r.headers.get("Last-Modified"), digest)
+        
+        # Parse in a worker thread so API requests aren't stalled meanwhile
+        spots = await asyncio.to_thread(parse_cisia, r.content)
+        return spots, validators
     except Exception as e:
         logger.error(f"Scrape error: {e}")
-    return spots
+        return None
+
+
+def remember_validators(validators: tuple):
+    """Record a processed page so the next conditional scrape can skip it."""
+    state.last_etag, state.last_modified, state.last_content_hash = validators
+
+
+async def ensure_indexes():
+    """Create indexes for the hot query paths (idempotent)."""
+    specs = [
+        (db.notifications, [("user_id", 1), ("sent_at", -1)], {}),
+        (db.users, "user_id", {"unique": True}),
+        (db.users, "email", {"unique": True}),
+        (db.users, "telegram_chat_id", {}),
+        # Covers the alert fan-out query; only subscribed users are indexed
+        (db.users, [("alert_telegram", 1), ("telegram_chat_id", 1), ("user_id", 1)],
+         {"partialFilterExpression": {"alert_telegram": True}}),
+        (db.user_sessions, "session_token", {"unique": True}),
+        (db.user_sessions, "expires_at", {"expireAfterSeconds": 0}),
+        (db.availability_snapshots, [("timestamp", -1)], {}),
+    ]
+    for collection, keys, opts in specs:
+        try:
+            await collection.create_index(keys, **opts)
+        except Exception as e:
+            # e.g. legacy duplicates blocking a unique index - don't skip the rest
+            logger.error(f"Index error on {collection.name} {keys}: {e}")
 
 
 async def cleanup_old_data():
     """Delete old snapshots and sessions to stay under 512MB."""
     try:
-        # Keep only last 24 hours of snapshots
-        cutoff = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
-        result = await db.availability_snapshots.delete_many({"timestamp": {"$lt": cutoff}})
-        if result.deleted_count > 0:
-            logger.info(f"🧹 Cleaned {result.deleted_count} old snapshots")
+        # Keep only last 24 hours of snapshots - but never the latest one,
+        # since snapshots are only written when availability changes
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=24)
+        latest = await db.availability_snapshots.find_one({}, {"_id": 1}, sort=[("timestamp", -1)])
+        if latest:
+            # Native datetimes and legacy ISO strings don't compare across
+            # BSON types, so match each form against its own cutoff
+            result = await db.availability_snapshots.delete_many({
+                "_id": {"$ne": latest["_id"]},
+                "$or": [
+                    {"timestamp": {"$lt": cutoff}},
+                    {"timestamp": {"$lt": cutoff.isoformat()}}
+                ]
+            })
+            if result.deleted_count > 0:
+                logger.info(f"🧹 Cleaned {result.deleted_count} old snapshots")
         
-        # Delete expired sessions
+        # Delete expired sessions stored with ISO-string expiry (the TTL
+        # index only handles native datetimes)
         now = datetime.now(timezone.utc).isoformat()
         result = await db.user_sessions.delete_many({"expires_at": {"$lt": now}})
         if result.deleted_count > 0:
@@ -380,109 +759,323 @@ async def cleanup_old_data():
         logger.error(f"Cleanup error: {e}")
 
 
+BOOK_URL = "https://testcisia.it/studenti_tolc/login_sso.php"
+_SPOT_TMPL = "🏫 {university}\n📍 {city}\n📅 {test_date}\n🎫 {spots}"
+_ALERT_FOOTER = f"<a href='{BOOK_URL}'>BOOK NOW</a>"
+
+
+def format_spot_alert(spots: List[dict]) -> str:
+    """One Telegram message covering every spot that opened this cycle.
+    
+    Built once per cycle and shared by every recipient.
+    """
+    header = "🟢 <b>SPOT AVAILABLE!</b>" if len(spots) == 1 else f"🟢 <b>{len(spots)} SPOTS AVAILABLE!</b>"
+    blocks = (
+        _SPOT_TMPL.format(
+            university=escape_html(spot['university']), city=escape_html(spot['city']),
+            test_date=escape_html(spot['test_date']), spots=escape_html(spot['spots'])
+        )
+        for spot in spots
+    )
+    return "\n\n".join([header, *blocks, _ALERT_FOOTER])
+
+
+async def notify_users_about_spots(spots: List[dict]):
+    """Broadcast newly opened spots to all subscribed users concurrently.
+    
+    Users are queried once per cycle and get a single consolidated message,
+    however many spots opened.
+    """
+    if not spots:
+        return
+    
+    alert = format_spot_alert(spots)
+    cursor = db.users.find(
+        {"alert_telegram": True, "telegram_chat_id": {"$ne": None}},
+        {"_id": 0, "user_id": 1, "telegram_chat_id": 1}
+    ).batch_size(100)
+    
+    # Send in chunks of SEND_CONCURRENCY, at most one chunk per second, so
+    # the broadcast overlaps round-trips but stays under Telegram's global
+    # limit. Users stream from Mongo, so the first chunk goes out as soon as
+    # the first batch arrives.
+    loop = asyncio.get_running_loop()
+    results = []
+    chunk = []
+    next_chunk_at = 0.0
+    
+    async def send_chunk():
+        nonlocal next_chunk_at
+        delay = next_chunk_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        next_chunk_at = loop.time() + SEND_CHUNK_INTERVAL
+        oks = await asyncio.gather(
+            *(send_msg(u['telegram_chat_id'], alert) for u in chunk),
+            return_exceptions=True
+        )
+        results.extend(zip(chunk, oks))
+    
+    async for user in cursor:
+        chunk.append(user)
+        if len(chunk) == SEND_CONCURRENCY:
+            await send_chunk()
+            chunk = []
+    if chunk:
+        await send_chunk()
+    
+    sent_at = datetime.now(timezone.utc)
+    docs = [
+        {
+            "notification_id": str(uuid.uuid4()),
+            "user_id": user['user_id'],
+            "chat_id": user['telegram_chat_id'],
+            "type": "telegram",
+            "message": alert,
+            "spot_key": spot_key(spot_info),
+            "spot_info": spot_info,
+            "status": "sent",
+            "sent_at": sent_at
+        }
+        for user, ok in results
+        if ok is True
+        for spot_info in spots
+    ]
+    if docs:
+        await db.notifications.insert_many(docs, ordered=False)
+    
+    sent = sum(1 for _, ok in results if ok is True)
+    logger.info(f"📣 Alerted {sent}/{len(results)} users about {len(spots)} spot(s)")
+
+
+async def load_last_available_keys():
+    """Seed the in-memory diff baseline from the latest stored snapshot."""
+    try:
+        last = await db.availability_snapshots.find_one(
+            {}, {"_id": 0, "content_hash": 1, "available_keys": 1}, sort=[("timestamp", -1)]
+        )
+        if last and 'available_keys' not in last:
+            # Snapshot predates available_keys - rebuild from the spot list
+            last = await db.availability_snapshots.find_one(
+                {}, {"_id": 0, "spots.university": 1, "spots.test_date": 1, "spots.status": 1},
+                sort=[("timestamp", -1)]
+            )
+            last['available_keys'] = [
+                f"{s.get('university')}|{s.get('test_date')}"
+                for s in last.get('spots', []) if "DISPONIBILI" in s.get('status', '').upper()
+            ]
+        if last:
+            state.last_snapshot_hash = last.get('content_hash')
+            state.last_available_keys = set(last['available_keys'])
+    except Exception as e:
+        logger.error(f"Baseline load error: {e}")
+
+
 async def check_spots():
     """Check for new spots and notify users."""
     logger.info("🔍 Checking CISIA...")
     
     await cleanup_old_data()
     
-    spots = await scrape_cisia()
-    available = [s for s in spots if "DISPONIBILI" in s.status.upper()]
+    heartbeat_due = time.time() - state.last_snapshot_at >= SNAPSHOT_HEARTBEAT
+    
+    result = await scrape_cisia(conditional=not heartbeat_due)
+    if result is None:
+        logger.info("⏸️ No new CISIA data, skipping")
+        return
+    spots, validators = result
+    
+    # Cheap fingerprint of the scraped rows (spot_id only encodes row order,
+    # so it's left out). Unchanged + no heartbeat due = nothing to do.
+    snapshot_hash = hashlib.blake2b(
+        orjson.dumps([
+            (s['type'], s['university'], s['region'], s['city'],
+             s['registration_deadline'], s['spots'], s['status'], s['test_date'])
+            for s in spots
+        ]),
+        digest_size=16
+    ).hexdigest()
+    if snapshot_hash == state.last_snapshot_hash and not heartbeat_due:
+        remember_validators(validators)
+        logger.info("⏸️ Spots unchanged, skipping")
+        return
     
-    last = await db.availability_snapshots.find_one({}, {"_id": 0}, sort=[("timestamp", -1)])
+    available = [s for s in spots if s['is_available']]
+    # Key each spot once; the diff below reuses these instead of rebuilding them
+    keyed = [(spot_key(s), s) for s in available]
+    new_keys = {k for k, _ in keyed}
     
-    await db.availability_snapshots.insert_one({
+    snapshot = {
         "snapshot_id": str(uuid.uuid4()),
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "spots": [s.model_dump() for s in spots],
-        "available_count": len(available)
-    })
+        "timestamp": datetime.now(timezone.utc),
+        "spots": spots,
+        "available_count": len(available),
+        "available_keys": list(new_keys),
+        "content_hash": snapshot_hash
+    }
+    await db.availability_snapshots.insert_one(snapshot)
+    # Pre-serialize both /availability variants once per snapshot; swapping
+    # in a fresh dict means readers never need a lock
+    summary = {
+        "timestamp": snapshot["timestamp"],
+        "available_count": len(available),
+        "total_cent_casa": len(spots)
+    }
+    state.latest_snapshot = {
+        "body": orjson.dumps({**summary, "spots": spots}),
+        "available_body": orjson.dumps({**summary, "spots": available})
+    }
+    state.last_snapshot_hash = snapshot_hash
+    state.last_snapshot_at = time.time()
     
-    if last:
-        old_keys = {f"{s.get('university')}|{s.get('test_date')}" 
-                    for s in last.get('spots', []) if "DISPONIBILI" in s.get('status', '').upper()}
-        
-        for spot in available:
-            if f"{spot.university}|{spot.test_date}" not in old_keys:
-                logger.info(f"🆕 NEW: {spot.university}")
-                # Notify users
-                users = await db.users.find({"alert_telegram": True}, {"_id": 0}).to_list(1000)
-                for user in users:
-                    cid = user.get('telegram_chat_id')
-                    if cid:
-                        alert = (
-                            f"🟢 <b>SPOT AVAILABLE!</b>\n\n"
-                            f"🏫 {spot.university}\n📍 {spot.city}\n"
-                            f"📅 {spot.test_date}\n🎫 {spot.spots}\n\n"
-                            f"<a href='https://testcisia.it/studenti_tolc/login_sso.php'>BOOK NOW</a>"
-                        )
-                        await send_msg(cid, alert)
+    old_keys = state.last_available_keys
+    state.last_available_keys = new_keys
+    # Only now is the page fully stored and diffed; if anything above
+    # failed, the next conditional scrape must not treat it as seen
+    remember_validators(validators)
+    
+    if old_keys is not None:
+        added = new_keys - old_keys
+        new_spots = [s for k, s in keyed if k in added] if added else []
+        for spot in new_spots:
+            logger.info(f"🆕 NEW: {spot['university']}")
+        await notify_users_about_spots(new_spots)
     
     logger.info(f"✅ Done: {len(available)} available")
 
 
+async def sleep_until(deadline: float, interval: float, name: str, wake: asyncio.Event = None) -> float:
+    """Sleep until `deadline` on the loop clock; return the deadline reached.
+    
+    Keeps loops on a fixed grid regardless of how long the work took.
+    If the work overran, missed ticks are skipped rather than bunched up.
+    Setting `wake` (default: the shutdown event) ends the sleep early.
+    """
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    if deadline < now:
+        missed = int((now - deadline) // interval) + 1
+        logger.warning(f"⏱️ {name} overran, skipping {missed} tick(s)")
+        deadline += missed * interval
+    try:
+        # Returns early on shutdown instead of sleeping out the interval
+        await asyncio.wait_for((wake or state.stop_event).wait(), timeout=deadline - now)
+    except asyncio.TimeoutError:
+        pass
+    return deadline
+
+
 async def scraper_loop():
     """Scraper loop."""
-    state.scraper_running = True
-    while state.scraper_running:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    while not state.stop_event.is_set():
+        state.scrape_wake.clear()
         try:
             await check_spots()
         except Exception as e:
             logger.error(f"Scraper error: {e}")
-        await asyncio.sleep(30)
+        # A manual refresh wakes us early; the pending tick still stands
+        if loop.time() >= deadline:
+            deadline += 30
+        deadline = await sleep_until(deadline, 30, "Scraper", state.scrape_wake)
 
 
 async def monitor_loop(base_url: str):
     """Health monitor loop."""
-    state.monitor_running = True
-    while state.monitor_running:
+    deadline = asyncio.get_running_loop().time()
+    while not state.stop_event.is_set():
         try:
-            await asyncio.sleep(30)
+            interval = HEALTH_FAST_INTERVAL if state.consecutive_ok < HEALTH_OK_STREAK else HEALTH_SLOW_INTERVAL
+            deadline = await sleep_until(deadline + interval, interval, "Monitor")
+            if state.stop_event.is_set():
+                break
             await check_webhook_health(base_url)
         except Exception as e:
             logger.error(f"Monitor error: {e}")
 
 
+def resolve_base_url() -> str:
+    """Public base URL for the webhook; resolved once and kept on state."""
+    if state.base_url is None:
+        base_url = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+        if not base_url:
+            try:
+                m = _ENV_RE.search(FRONTEND_ENV.read_text())
+                if m:
+                    base_url = m.group(1).strip().rstrip('/')
+            except OSError:
+                pass
+        if base_url:
+            state.base_url = base_url
+    return state.base_url or ""
+
+
 # ========== FASTAPI ==========
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global TG_CLIENT, SCRAPE_CLIENT, AUTH_CLIENT
+    
     logger.info("=" * 50)
     logger.info("🚀 CEnT-S ALERT v3 - DUAL MODE")
     logger.info("=" * 50)
     
+    # Shared HTTP clients - one TLS handshake, reused for every call
+    TG_CLIENT = httpx.AsyncClient(
+        base_url=f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}",
+        timeout=httpx.Timeout(15.0, pool=TELEGRAM_POOL_TIMEOUT),
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=TELEGRAM_POOL_SIZE,
+            max_keepalive_connections=max(1, TELEGRAM_POOL_SIZE // 2)
+        )
+    )
+    SCRAPE_CLIENT = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        headers={"User-Agent": "Mozilla/5.0"},
+        limits=httpx.Limits(max_connections=SCRAPE_POOL_SIZE, max_keepalive_connections=SCRAPE_POOL_SIZE)
+    )
+    AUTH_CLIENT = httpx.AsyncClient(
+        http2=True,
+        headers={"User-Agent": "Mozilla/5.0"},
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+    )
+    
+    await ensure_indexes()
+    await load_last_available_keys()
+    
+    for i in range(MSG_WORKERS):
+        spawn(message_worker(), name=f"msg-worker-{i}")
+    for i in range(REPLY_WORKERS):
+        spawn(reply_worker(), name=f"reply-worker-{i}")
+    
     # Get bot info
-    info = await tg_api("getMe")
-    state.bot_username = info.get("result", {}).get("username", "unknown")
+    await get_bot_info()
     logger.info(f"🤖 Bot: @{state.bot_username}")
     
-    # Get base URL
-    base_url = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
-    if not base_url:
-        try:
-            env = Path("/app/frontend/.env").read_text()
-            for line in env.split('\n'):
-                if line.startswith('REACT_APP_BACKEND_URL='):
-                    base_url = line.split('=', 1)[1].strip().strip('"').rstrip('/')
-        except:
-            pass
-    
+    base_url = resolve_base_url()
     if base_url:
         await setup_webhook(base_url)
-        asyncio.create_task(monitor_loop(base_url))
+        spawn(monitor_loop(base_url), name="monitor")
     
-    asyncio.create_task(scraper_loop())
+    spawn(scraper_loop(), name="scraper")
     
     logger.info("=" * 50)
     yield
     
-    state.scraper_running = False
-    state.monitor_running = False
+    state.stop_event.set()
+    state.scrape_wake.set()
     stop_polling()
+    await cancel_background_tasks()
     await tg_api("deleteWebhook")
+    await TG_CLIENT.aclose()
+    await SCRAPE_CLIENT.aclose()
+    await AUTH_CLIENT.aclose()
     client.close()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 api = APIRouter(prefix="/api")
 
 
@@ -490,16 +1083,64 @@ api = APIRouter(prefix="/api")
 @api.post("/tg/wh")
 async def telegram_webhook(request: Request):
     """Telegram webhook - simple path for reliability."""
+    # Telegram echoes secret_token back; anything else isn't from Telegram.
+    # Checked before reading the body so forged requests cost nothing.
+    # Bytes, since compare_digest raises on non-ASCII str (headers are latin-1)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode("latin-1"), _WEBHOOK_SECRET_BYTES):
+        raise HTTPException(403, "Forbidden")
+    
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         if "message" in data:
-            asyncio.create_task(handle_message(data["message"]))
-        return {"ok": True}
-    except:
-        return {"ok": True}
+            try:
+                MSG_QUEUE.put_nowait(data["message"])
+            except asyncio.QueueFull:
+                logger.warning("⚠️ Message queue full, dropping update")
+    except orjson.JSONDecodeError:
+        logger.warning("Webhook: invalid JSON payload")
+    except Exception:
+        pass
+    return ORJSONResponse({"ok": True})
 
 
 # ========== AUTH ==========
+# session_token -> (user doc, cached_until). Saves two Mongo round trips per
+# authenticated request; entries never outlive the session itself.
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_MAX = 4096
+_session_cache: dict = {}
+_session_inflight: dict = {}  # session_token -> in-progress lookup task
+_session_generation = 0  # bumped on invalidation so in-flight lookups don't cache stale docs
+
+
+def _cache_session(token: str, user: dict, expires_at: datetime):
+    now = time.time()
+    if len(_session_cache) >= SESSION_CACHE_MAX:
+        for t in [t for t, (_, until) in _session_cache.items() if until <= now]:
+            del _session_cache[t]
+        if len(_session_cache) >= SESSION_CACHE_MAX:
+            _session_cache.pop(next(iter(_session_cache)))
+    _session_cache[token] = (user, min(now + SESSION_CACHE_TTL, expires_at.timestamp()))
+
+
+def revoke_session(token: str):
+    """Forget a deleted session, including any lookup already in flight."""
+    global _session_generation
+    _session_generation += 1
+    _session_cache.pop(token, None)
+    # Later requests must not join a lookup that may predate the delete
+    _session_inflight.pop(token, None)
+
+
+def invalidate_user_sessions(user_id: str):
+    """Drop cached sessions for a user after their document changes."""
+    global _session_generation
+    _session_generation += 1
+    for t in [t for t, (u, _) in _session_cache.items() if u.get('user_id') == user_id]:
+        del _session_cache[t]
+
+
 async def get_user(request: Request):
     token = request.cookies.get('session_token')
     if not token:
@@ -509,7 +1150,32 @@ async def get_user(request: Request):
     if not token:
         return None
     
-    session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
+    cached = _session_cache.get(token)
+    if cached:
+        user, until = cached
+        if until > time.time():
+            return user
+        del _session_cache[token]
+    
+    # Single-flight: concurrent misses for one token (e.g. the dashboard's
+    # parallel requests on load) share a single pair of Mongo lookups
+    task = _session_inflight.get(token)
+    if task is None:
+        task = asyncio.ensure_future(_load_session_user(token))
+        _session_inflight[token] = task
+        task.add_done_callback(lambda t: _forget_inflight(token, t))
+    return await asyncio.shield(task)
+
+
+def _forget_inflight(token: str, task: asyncio.Task):
+    # revoke_session may already have replaced this entry with a newer lookup
+    if _session_inflight.get(token) is task:
+        del _session_inflight[token]
+
+
+async def _load_session_user(token: str):
+    generation = _session_generation
+    session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0, "user_id": 1, "expires_at": 1})
     if not session:
         return None
     
@@ -521,23 +1187,25 @@ async def get_user(request: Request):
     if exp < datetime.now(timezone.utc):
         return None
     
-    return await db.users.find_one({"user_id": session['user_id']}, {"_id": 0})
+    user = await db.users.find_one({"user_id": session['user_id']}, {"_id": 0})
+    if user and generation == _session_generation:
+        _cache_session(token, user, exp)
+    return user
 
 
 @api.post("/auth/session")
 async def auth_session(request: Request, response: Response):
-    body = await request.json()
+    body = orjson.loads(await request.body())
     sid = body.get('session_id')
     if not sid:
         raise HTTPException(400, "session_id required")
     
     try:
-        async with httpx.AsyncClient() as http:
-            r = await http.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": sid}
-            )
-            auth = r.json()
+        r = await AUTH_CLIENT.get(
+            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+            headers={"X-Session-ID": sid}
+        )
+        auth = orjson.loads(r.content)
     except:
         raise HTTPException(401, "Invalid session")
     
@@ -546,26 +1214,31 @@ async def auth_session(request: Request, response: Response):
     picture = auth.get('picture')
     token = auth.get('session_token')
     
-    existing = await db.users.find_one({"email": email}, {"_id": 0})
-    
-    if existing:
-        uid = existing['user_id']
-        await db.users.update_one({"email": email}, {"$set": {"name": name, "picture": picture}})
-    else:
-        uid = f"user_{uuid.uuid4().hex[:12]}"
-        await db.users.insert_one({
-            "user_id": uid, "email": email, "name": name, "picture": picture,
-            "telegram_chat_id": None, "alert_telegram": False,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        })
+    # Create-or-update in one round trip; new-user fields only apply on insert
+    user = await db.users.find_one_and_update(
+        {"email": email},
+        {
+            "$set": {"name": name, "picture": picture},
+            "$setOnInsert": {
+                "user_id": f"user_{uuid.uuid4().hex[:12]}",
+                "telegram_chat_id": None, "alert_telegram": False,
+                "created_at": datetime.now(timezone.utc)
+            }
+        },
+        upsert=True,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    uid = user['user_id']
+    invalidate_user_sessions(uid)
     
     await db.user_sessions.insert_one({
         "session_token": token, "user_id": uid,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        # Native datetime so the expires_at TTL index can purge it
+        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "created_at": datetime.now(timezone.utc)
     })
     
-    user = await db.users.find_one({"user_id": uid}, {"_id": 0})
     response.set_cookie("session_token", token, httponly=True, secure=True, samesite="none", path="/", max_age=604800)
     
     return {"user": user, "needs_telegram": not user.get('telegram_chat_id')}
@@ -583,7 +1256,10 @@ async def auth_me(request: Request):
 async def auth_logout(request: Request, response: Response):
     token = request.cookies.get('session_token')
     if token:
+        # Delete first: evicting before the delete lets a request in the
+        # gap reload and re-cache the session
         await db.user_sessions.delete_one({"session_token": token})
+        revoke_session(token)
     response.delete_cookie("session_token", path="/", secure=True, samesite="none")
     return {"status": "ok"}
 
@@ -595,12 +1271,16 @@ async def connect_telegram(request: Request, data: TelegramConnectRequest):
     if not user:
         raise HTTPException(401)
     
-    await db.users.update_one(
+    updated = await db.users.find_one_and_update(
         {"user_id": user['user_id']},
-        {"$set": {"telegram_chat_id": data.chat_id, "alert_telegram": True}}
+        {"$set": {"telegram_chat_id": data.chat_id, "alert_telegram": True}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    await send_msg(data.chat_id, "✅ <b>Connected!</b> You'll get alerts when spots open.")
-    return await db.users.find_one({"user_id": user['user_id']}, {"_id": 0})
+    invalidate_user_sessions(user['user_id'])
+    # Don't hold the HTTP response on Telegram
+    spawn(send_msg(data.chat_id, "✅ <b>Connected!</b> You'll get alerts when spots open."))
+    return updated
 
 
 @api.put("/users/alerts")
@@ -609,8 +1289,14 @@ async def update_alerts(request: Request, settings: AlertSettingsRequest):
     if not user:
         raise HTTPException(401)
     
-    await db.users.update_one({"user_id": user['user_id']}, {"$set": {"alert_telegram": settings.alert_telegram}})
-    return await db.users.find_one({"user_id": user['user_id']}, {"_id": 0})
+    updated = await db.users.find_one_and_update(
+        {"user_id": user['user_id']},
+        {"$set": {"alert_telegram": settings.alert_telegram}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_user_sessions(user['user_id'])
+    return updated
 
 
 # ========== TELEGRAM INFO ==========
@@ -618,53 +1304,103 @@ async def update_alerts(request: Request, settings: AlertSettingsRequest):
 async def bot_info():
     if not TELEGRAM_BOT_TOKEN:
         raise HTTPException(503)
-    info = await tg_api("getMe")
-    if info.get("ok"):
-        return {"username": info["result"]["username"], "name": info["result"]["first_name"]}
+    info = await get_bot_info()
+    if info:
+        return info
     raise HTTPException(503)
 
 
 # ========== AVAILABILITY ==========
+_FIELD_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+
 @api.get("/availability")
-async def get_availability():
-    snap = await db.availability_snapshots.find_one({}, {"_id": 0}, sort=[("timestamp", -1)])
-    if snap:
-        return {
-            "timestamp": snap.get('timestamp'),
-            "spots": snap.get('spots', []),
-            "available_count": snap.get('available_count', 0),
-            "total_cent_casa": len(snap.get('spots', []))
-        }
-    spots = await scrape_cisia()
+async def get_availability(available_only: bool = False):
+    """Latest snapshot, from memory once the scraper has stored one.
+    
+    On a cold start it falls back to Mongo, where available_only=true
+    filters the spots server-side.
+    """
+    latest = state.latest_snapshot
+    if latest:
+        body = latest["available_body"] if available_only else latest["body"]
+        return Response(content=body, media_type="application/json")
+    
+    spots_expr = "$spots"
+    if available_only:
+        spots_expr = {"$filter": {
+            "input": "$spots", "as": "s",
+            "cond": {"$regexMatch": {"input": "$$s.status", "regex": "DISPONIBILI", "options": "i"}}
+        }}
+    pipeline = [
+        {"$sort": {"timestamp": -1}},
+        {"$limit": 1},
+        {"$project": {
+            "_id": 0,
+            "timestamp": 1,
+            "available_count": {"$ifNull": ["$available_count", 0]},
+            "total_cent_casa": {"$size": {"$ifNull": ["$spots", []]}},
+            "spots": {"$ifNull": [spots_expr, []]}
+        }}
+    ]
+    snaps = await db.availability_snapshots.aggregate(pipeline).to_list(1)
+    if snaps:
+        return snaps[0]
+    result = await scrape_cisia()
+    spots = result[0] if result else []
     return {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "spots": [s.model_dump() for s in spots],
-        "available_count": len([s for s in spots if "DISPONIBILI" in s.status.upper()]),
+        "timestamp": datetime.now(timezone.utc),
+        "spots": [s for s in spots if s['is_available'] or not available_only],
+        "available_count": sum(1 for s in spots if s['is_available']),
         "total_cent_casa": len(spots)
     }
 
 
 @api.get("/availability/history")
-async def availability_history(limit: int = 50):
-    return await db.availability_snapshots.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
+async def availability_history(limit: int = 50, fields: Optional[str] = None):
+    """Recent snapshots. `fields` (e.g. "timestamp,available_count,spots.university")
+    projects only those paths instead of returning whole documents."""
+    projection = {"_id": 0}
+    if fields:
+        paths = sorted({f.strip() for f in fields.split(',') if f.strip()})
+        if not all(_FIELD_RE.match(f) for f in paths):
+            raise HTTPException(400, "invalid fields")
+        # _id would override the exclusion and can't be serialized; a path
+        # nested under another selected path is a Mongo projection collision.
+        # Sorted, so any such parent sits directly before one of its children.
+        if any(f == "_id" or f.startswith("_id.") for f in paths) or any(
+            nxt.startswith(cur + ".") for cur, nxt in zip(paths, paths[1:])
+        ):
+            raise HTTPException(400, "invalid fields")
+        projection.update({f: 1 for f in paths})
+    return await db.availability_snapshots.find({}, projection).sort("timestamp", -1).limit(limit).to_list(limit)
 
 
 @api.post("/availability/refresh")
-async def refresh(background_tasks: BackgroundTasks, request: Request):
+async def refresh(request: Request):
     user = await get_user(request)
     if not user:
         raise HTTPException(401)
-    background_tasks.add_task(check_spots)
+    # Run on the scraper loop rather than alongside it, so refreshes
+    # can't race a scheduled check or pile up
+    state.scrape_wake.set()
     return {"status": "started"}
 
 
 # ========== NOTIFICATIONS ==========
+# Only what the history page renders - skips chat_id, spot_key and the rest of spot_info
+_NOTIF_PROJECTION = {
+    "_id": 0, "notification_id": 1, "type": 1, "message": 1, "status": 1, "sent_at": 1,
+    "spot_info.university": 1, "spot_info.city": 1, "spot_info.region": 1
+}
+
+
 @api.get("/notifications/history")
 async def notif_history(request: Request, limit: int = 50):
     user = await get_user(request)
     if not user:
         raise HTTPException(401)
-    return await db.notifications.find({"user_id": user['user_id']}, {"_id": 0}).sort("sent_at", -1).limit(limit).to_list(limit)
+    return await db.notifications.find({"user_id": user['user_id']}, _NOTIF_PROJECTION).sort("sent_at", -1).limit(limit).to_list(limit)
 
 
 # ========== HEALTH ==========
@@ -685,14 +1421,17 @@ async def health():
         "messages": {"in": state.msg_received_count, "out": state.msg_sent_count},
         "health_checks": state.health_checks,
         "auto_recoveries": state.auto_recoveries,
-        "errors": state.errors
+        "errors": state.errors,
+        "telegram_circuit": {"state": tg_breaker.state, "trips": tg_breaker.trips},
+        "queues": {"inbound": MSG_QUEUE.qsize(), "replies": REPLY_QUEUE.qsize()},
+        "background_tasks": len(_background_tasks)
     }
 
 
 @api.post("/telegram/force-repair")
 async def force_repair():
     """Force webhook re-registration."""
-    base_url = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+    base_url = resolve_base_url()
     if base_url:
         await setup_webhook(base_url)
         return {"status": "done", "mode": state.mode}
@@ -707,6 +1446,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Spot lists are highly repetitive JSON; small responses aren't worth it
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # ========== STATIC FILES ==========
 # Serve frontend static files in production
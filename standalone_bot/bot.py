@@ -4,11 +4,15 @@
 import os
 import asyncio
 import logging
+import hashlib
+import random
+import re
 from datetime import datetime
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import Forbidden, NetworkError, RetryAfter, TelegramError
 import httpx
-from bs4 import BeautifulSoup
+from lxml import etree, html
 
 # ========== CONFIGURATION ==========
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
@@ -29,33 +33,96 @@ subscribers = set()
 # ========== SCRAPER ==========
 CISIA_URL = "https://testcisia.it/calendario.php?tolc=cents&lingua=inglese"
 
-async def scrape_cisia():
-    """Scrape CISIA for CENT@CASA spots."""
+def _cell_text(cell) -> str:
+    """Equivalent of BeautifulSoup's get_text(strip=True)."""
+    return "".join(t.strip() for t in cell.itertext())
+
+
+_CASA_RE = re.compile(rb"CASA", re.IGNORECASE)
+
+# CASA rows only (case-insensitive on the first cell), selected inside
+# lxml so other rows are never turned into Python objects
+_CASA_ROWS = etree.XPath(
+    "(//table)[1]//tr[count(td) >= 7]"
+    "[contains(translate(td[1], 'cas', 'CAS'), 'CASA')]"
+)
+
+
+def parse_cisia(body):
+    """Extract CENT@CASA rows from the CISIA page (sync - run it in a thread)."""
     spots = []
+    # Page lists no CASA sessions at all - skip building the tree
+    if not _CASA_RE.search(body):
+        return spots
+    
+    # Raw bytes let lxml do its own encoding detection
+    doc = html.fromstring(body)
+    
+    for row in _CASA_ROWS(doc):
+        cells = row.findall('td')
+        has_link = cells[6].find('.//a') is not None
+        spots.append({
+            "university": _cell_text(cells[1]),
+            "city": _cell_text(cells[3]),
+            "deadline": _cell_text(cells[4]),
+            "spots": _cell_text(cells[5]),
+            "available": has_link,
+            "test_date": _cell_text(cells[7]) if len(cells) > 7 else ""
+        })
+    return spots
+
+
+# Shared client - keeps the CISIA connection alive between polls
+http_client = None
+
+# Validators from the last conditional scrape
+last_etag = None
+last_modified = None
+last_content_hash = None
+
+
+async def scrape_cisia(conditional=False):
+    """Scrape CISIA for CENT@CASA spots.
+    
+    Returns None if the fetch failed, or with conditional=True if the page
+    hasn't changed since the last conditional scrape (HTTP 304 or identical
+    body).
+    """
+    global last_etag, last_modified, last_content_hash
     try:
-        async with httpx.AsyncClient(timeout=30.0) as http:
-            r = await http.get(CISIA_URL, headers={"User-Agent": "Mozilla/5.0"})
-            soup = BeautifulSoup(r.text, 'lxml')
-            table = soup.find('table')
-            
-            if table:
-                for row in table.find_all('tr'):
-                    cells = row.find_all('td')
-                    if len(cells) >= 7:
-                        test_type = cells[0].get_text(strip=True)
-                        if "CASA" in test_type.upper():
-                            has_link = cells[6].find('a') is not None
-                            spots.append({
-                                "university": cells[1].get_text(strip=True),
-                                "city": cells[3].get_text(strip=True),
-                                "deadline": cells[4].get_text(strip=True),
-                                "spots": cells[5].get_text(strip=True),
-                                "available": has_link,
-                                "test_date": cells[7].get_text(strip=True) if len(cells) > 7 else ""
-                            })
+        headers = {"User-Agent": "Mozilla/5.0"}
+        if conditional:
+            if last_etag:
+                headers["If-None-Match"] = last_etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        
+        r = await http_client.get(CISIA_URL, headers=headers)
+        
+        if conditional and r.status_code == 304:
+            return None
+        if r.status_code != 200:
+            # An error page isn't an empty calendar
+            logger.error(f"Scrape error: HTTP {r.status_code}")
+            return None
+        
+        digest = hashlib.blake2b(r.content, digest_size=16).digest()
+        if conditional and digest == last_content_hash:
+            return None
+        
+        # lxml releases the GIL while parsing, so a thread keeps the bot
+        # answering commands during the scrape
+        spots = await asyncio.to_thread(parse_cisia, r.content)
+        
+        # Only a page that parsed counts as seen
+        if conditional:
+            last_etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            last_content_hash = digest
+        return spots
     except Exception as e:
         logger.error(f"Scrape error: {e}")
-    return spots
+        return None
 
 # ========== BOT HANDLERS ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -77,7 +144,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /status command."""
     chat_id = update.effective_chat.id
-    spots = await scrape_cisia()
+    spots = await scrape_cisia() or []
     available = [s for s in spots if s["available"]]
     
     await update.message.reply_html(
@@ -118,7 +185,7 @@ async def check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /check command - check spots now."""
     await update.message.reply_text("🔍 Checking CISIA...")
     
-    spots = await scrape_cisia()
+    spots = await scrape_cisia() or []
     available = [s for s in spots if s["available"]]
     
     if available:
@@ -144,14 +211,58 @@ async def handle_any(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ========== BACKGROUND SCRAPER ==========
 last_available = set()
 
+# Telegram allows ~30 msg/s globally - stay just under it when broadcasting
+SEND_CONCURRENCY = 25
+SEND_RETRIES = 3
+
+
+async def broadcast(app, msg):
+    """Send an alert to every subscriber concurrently."""
+    sem = asyncio.Semaphore(SEND_CONCURRENCY)
+    
+    async def _one(chat_id):
+        async with sem:
+            for attempt in range(SEND_RETRIES):
+                try:
+                    await app.bot.send_message(chat_id, msg, parse_mode="HTML")
+                    logger.info(f"Alert sent to {chat_id}")
+                    return
+                except RetryAfter as e:
+                    # Flood control - wait exactly as long as Telegram asks
+                    logger.warning(f"Rate limited sending to {chat_id}, retry in {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+                except Forbidden as e:
+                    # Bot blocked or chat gone - stop alerting this subscriber
+                    logger.info(f"Dropping subscriber {chat_id}: {e}")
+                    subscribers.discard(chat_id)
+                    return
+                except NetworkError as e:
+                    # Includes TimedOut - transient, back off and retry
+                    logger.warning(f"Send to {chat_id} failed ({attempt + 1}/{SEND_RETRIES}): {e}")
+                    # Full jitter so a network blip doesn't retry every chat at once
+                    await asyncio.sleep(random.uniform(0, 2 ** attempt))
+                except TelegramError as e:
+                    logger.error(f"Failed to send to {chat_id}: {e}")
+                    return
+            logger.error(f"Gave up sending to {chat_id} after {SEND_RETRIES} attempts")
+    
+    await asyncio.gather(*[_one(chat_id) for chat_id in subscribers.copy()])
+
 async def check_and_alert(app):
     """Check for new spots and alert subscribers."""
     global last_available
     
     while True:
         try:
-            spots = await scrape_cisia()
-            available = {f"{s['university']}|{s['test_date']}" for s in spots if s["available"]}
+            spots = await scrape_cisia(conditional=True)
+            if spots is None:
+                # Unchanged or failed - either way keep the current baseline
+                logger.info("No new CISIA data, skipping")
+                await asyncio.sleep(30)
+                continue
+            
+            # Tuple keys - cheaper to build and hash than formatted strings
+            available = {(s["university"], s["test_date"]) for s in spots if s["available"]}
             
             # Find NEW spots
             new_spots = available - last_available
@@ -159,8 +270,7 @@ async def check_and_alert(app):
             if new_spots and subscribers:
                 # Get details of new spots
                 for spot in spots:
-                    key = f"{spot['university']}|{spot['test_date']}"
-                    if key in new_spots:
+                    if (spot["university"], spot["test_date"]) in new_spots:
                         msg = (
                             f"🟢 <b>NEW SPOT AVAILABLE!</b>\n\n"
                             f"🏫 {spot['university']}\n"
@@ -171,13 +281,7 @@ async def check_and_alert(app):
                             f"👉 <a href='https://testcisia.it/studenti_tolc/login_sso.php'>BOOK NOW!</a>"
                         )
                         
-                        for chat_id in subscribers.copy():
-                            try:
-                                await app.bot.send_message(chat_id, msg, parse_mode="HTML")
-                                logger.info(f"Alert sent to {chat_id}")
-                            except Exception as e:
-                                logger.error(f"Failed to send to {chat_id}: {e}")
-                                subscribers.discard(chat_id)
+                        await broadcast(app, msg)
             
             last_available = available
             logger.info(f"Check done: {len(available)} available, {len(subscribers)} subscribers")
@@ -207,9 +311,15 @@ def main():
     
     # Start background scraper
     async def post_init(application):
+        global http_client
+        http_client = httpx.AsyncClient(timeout=30.0, http2=True)
         asyncio.create_task(check_and_alert(application))
     
+    async def post_shutdown(application):
+        await http_client.aclose()
+    
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
     
     # Run with webhook or polling
     if WEBHOOK_URL:
@@ -218,11 +328,14 @@ def main():
             listen="0.0.0.0",
             port=PORT,
             url_path=BOT_TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}"
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            allowed_updates=[Update.MESSAGE]
         )
     else:
         logger.info("Starting polling mode")
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Long polling: Telegram holds getUpdates open for up to 30s, so an
+        # idle bot makes ~2 requests a minute instead of 6
+        app.run_polling(allowed_updates=[Update.MESSAGE], timeout=30)
 
 
 if __name__ == "__main__":